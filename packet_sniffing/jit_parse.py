@@ -0,0 +1,56 @@
+"""
+Numeric kernels extracting the IPv4 and TCP header fields with bit operations
+on a uint8 buffer (numpy array, bytearray or memoryview) at a given offset.
+
+With Numba installed they are compiled to machine code (@njit). Calling a
+compiled function from Python costs more than one Struct.unpack_from, so they
+are meant to be called from other @njit code looping over a whole batch of
+packets, not once per packet from Python.
+Without Numba they stay plain Python functions, which PyPy's JIT also turns
+into direct loads of the bytes.
+See: https://numba.readthedocs.io/en/stable/user/jit.html
+"""
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+"""
+IPv4 header (see parse_ipv4_header in raw_socket_packet_sniffer.py):
+  byte 0: version (4 bits) | IHL (4 bits, in 32 bits words)
+  bytes 6-7: flags (3 bits) | fragment offset (13 bits)
+  byte 8: TTL, byte 9: protocol
+  bytes 12-15: source address, bytes 16-19: destination address
+Addresses are returned as 32 bits integers in host order.
+"""
+@njit(cache=True)
+def ipv4_fields(buf, off):
+    version_ihl = buf[off]
+    version = version_ihl >> 4
+    ihl = (version_ihl & 0x0F) * 4
+    flags_frag = (buf[off + 6] << 8) | buf[off + 7]
+    ttl = buf[off + 8]
+    protocol = buf[off + 9]
+    src = (buf[off + 12] << 24) | (buf[off + 13] << 16) | (buf[off + 14] << 8) | buf[off + 15]
+    dest = (buf[off + 16] << 24) | (buf[off + 17] << 16) | (buf[off + 18] << 8) | buf[off + 19]
+    return version, ihl, flags_frag, ttl, protocol, src, dest
+
+
+"""
+TCP header (see parse_tcp_packet in raw_socket_packet_sniffer.py):
+  bytes 0-1: source port, bytes 2-3: destination port
+  bytes 4-7: sequence number, bytes 8-11: acknowledgment number
+  byte 12: data offset (4 high bits, in 32 bits words)
+  byte 13: flags CWR ECE URG ACK PSH RST SYN FIN
+"""
+@njit(cache=True)
+def tcp_fields(buf, off):
+    src_port = (buf[off] << 8) | buf[off + 1]
+    dest_port = (buf[off + 2] << 8) | buf[off + 3]
+    seq = (buf[off + 4] << 24) | (buf[off + 5] << 16) | (buf[off + 6] << 8) | buf[off + 7]
+    ack = (buf[off + 8] << 24) | (buf[off + 9] << 16) | (buf[off + 10] << 8) | buf[off + 11]
+    data_offset = (buf[off + 12] >> 4) * 4
+    flags = buf[off + 13]
+    return src_port, dest_port, seq, ack, data_offset, flags
@@ -0,0 +1,193 @@
+"""
+Decode a whole batch of captured packets at once into NumPy arrays, one array
+per header field (structure of arrays), instead of handling the packets one by
+one. Questions about the batch then become vectorized masks, e.g. all TCP SYN:
+
+    syn = batch.tcp_syn()
+    print(batch.ip_src[syn], batch.dst_port[syn])
+
+The arrays are filled by a loop compiled with Numba (see jit_parse.py) that
+reads the frames where the kernel put them: in a TPACKET_V3 ring block or in
+the recvmmsg() buffer. Needs numpy; numba is optional but much faster.
+
+Run it as root to print the TCP SYN packets seen on the wire:
+    sudo python3 packet_batch.py
+"""
+import ctypes
+import socket
+import sys
+
+import numpy as np
+
+from jit_parse import njit, ipv4_fields, tcp_fields
+from raw_socket_packet_sniffer import (BLOCK_SIZE, ETH_LEN, FRAME_SIZE, VLEN, create_recv_batch,
+                                       create_rx_ring, create_socket, mmsghdr, recv_batches, ring_blocks)
+
+ETH_P_IP = 0x0800
+TCP_SYN = 0x02
+TCP_ACK = 0x10
+# The ring headers are in host byte order, the sniffer reads them with "="
+LITTLE_ENDIAN = sys.byteorder == "little"
+# Smallest room a frame takes in a ring block. The kernel writes the frame at
+# tp_mac = TPACKET_ALIGN(TPACKET3_HDRLEN + 16) - ETH_LEN = 96 - 14 = 82 bytes
+# after its tpacket3_hdr, and the next one at the following 16 bytes boundary.
+# Frames on lo are not padded to 60 bytes and the BPF filter lets through IPv4
+# frames of any length, so a bare 14 bytes Ethernet header takes only 96 bytes.
+MIN_FRAME_STRIDE = 96
+
+# Name, type and shape (for one packet) of each array of a batch
+FIELDS = (
+    ("length", np.uint32, ()),
+    ("dst_mac", np.uint8, (6,)),
+    ("src_mac", np.uint8, (6,)),
+    ("ether_type", np.uint16, ()),
+    ("ttl", np.uint8, ()),
+    ("ip_proto", np.uint8, ()),
+    ("ip_src", np.uint32, ()),
+    ("ip_dst", np.uint32, ()),
+    ("src_port", np.uint16, ()),
+    ("dst_port", np.uint16, ()),
+    ("tcp_flags", np.uint8, ()),
+)
+
+
+class PacketBatch:
+    # The arrays are allocated once for `capacity` packets and reused for every
+    # batch. Reading a field (batch.ip_proto, ...) returns a view on the
+    # entries of the current batch only.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self._columns = {name: np.zeros((capacity,) + shape, dtype) for name, dtype, shape in FIELDS}
+
+    def __getattr__(self, name):
+        try:
+            return self._columns[name][:self.count]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __len__(self):
+        return self.count
+
+    # Packets of length lengths[i] at offsets[i] of buf (recvmmsg() buffer)
+    def fill(self, buf, offsets, lengths):
+        self.count = int(fill_frames(memoryview(buf), offsets, lengths, *self._columns.values()))
+
+    # Packets of the TPACKET_V3 ring block at block_off
+    def fill_block(self, ring, block_off):
+        self.count = int(fill_block(memoryview(ring), block_off, *self._columns.values()))
+
+    def tcp_syn(self):
+        return (self.ip_proto == socket.IPPROTO_TCP) & ((self.tcp_flags & (TCP_SYN | TCP_ACK)) == TCP_SYN)
+
+
+# Decode the frame of `size` bytes at `off` of buf into entry i of the arrays
+@njit(cache=True)
+def fill_one(buf, off, size, i, length, dst_mac, src_mac, ether_type, ttl, ip_proto,
+             ip_src, ip_dst, src_port, dst_port, tcp_flags):
+    length[i] = size
+    ether_type[i] = 0
+    ttl[i] = 0
+    ip_proto[i] = 0
+    ip_src[i] = 0
+    ip_dst[i] = 0
+    src_port[i] = 0
+    dst_port[i] = 0
+    tcp_flags[i] = 0
+    # Too short for an Ethernet header
+    if size < ETH_LEN:
+        dst_mac[i, :] = 0
+        src_mac[i, :] = 0
+        return
+    for k in range(6):
+        dst_mac[i, k] = buf[off + k]
+        src_mac[i, k] = buf[off + 6 + k]
+    ether_type[i] = (buf[off + 12] << 8) | buf[off + 13]
+    if ether_type[i] != ETH_P_IP or size < ETH_LEN + 20:
+        return
+
+    _, ihl, flags_frag, ttl[i], ip_proto[i], ip_src[i], ip_dst[i] = ipv4_fields(buf, off + ETH_LEN)
+    # Fragments after the first one have no transport header
+    if (flags_frag & 0x1FFF) != 0 or ihl < 20:
+        return
+    l4 = off + ETH_LEN + ihl
+    if ip_proto[i] == 6 and size >= ETH_LEN + ihl + 20:
+        src_port[i], dst_port[i], _, _, _, tcp_flags[i] = tcp_fields(buf, l4)
+    elif ip_proto[i] == 17 and size >= ETH_LEN + ihl + 8:
+        src_port[i] = (buf[l4] << 8) | buf[l4 + 1]
+        dst_port[i] = (buf[l4 + 2] << 8) | buf[l4 + 3]
+
+@njit(cache=True)
+def fill_frames(buf, offsets, lengths, length, dst_mac, src_mac, ether_type, ttl, ip_proto,
+                ip_src, ip_dst, src_port, dst_port, tcp_flags):
+    n = len(offsets)
+    for i in range(n):
+        fill_one(buf, offsets[i], lengths[i], i, length, dst_mac, src_mac, ether_type, ttl,
+                 ip_proto, ip_src, ip_dst, src_port, dst_port, tcp_flags)
+    return n
+
+# Host order integers of the ring headers. LITTLE_ENDIAN is a constant for
+# Numba, so only one of the branches is compiled.
+@njit(cache=True)
+def read_u16(buf, off):
+    if LITTLE_ENDIAN:
+        return buf[off] | (buf[off + 1] << 8)
+    return (buf[off] << 8) | buf[off + 1]
+
+@njit(cache=True)
+def read_u32(buf, off):
+    if LITTLE_ENDIAN:
+        return buf[off] | (buf[off + 1] << 8) | (buf[off + 2] << 16) | (buf[off + 3] << 24)
+    return (buf[off] << 24) | (buf[off + 1] << 16) | (buf[off + 2] << 8) | buf[off + 3]
+
+# Same walk over the tpacket3_hdr of a block as receive_ring() in the sniffer
+@njit(cache=True)
+def fill_block(buf, block_off, length, dst_mac, src_mac, ether_type, ttl, ip_proto,
+               ip_src, ip_dst, src_port, dst_port, tcp_flags):
+    n = read_u32(buf, block_off + 12)
+    if n > len(length):
+        n = len(length)
+    pkt_off = block_off + read_u32(buf, block_off + 16)
+    for i in range(n):
+        snaplen = read_u32(buf, pkt_off + 12)
+        mac = read_u16(buf, pkt_off + 24)
+        fill_one(buf, pkt_off + mac, snaplen, i, length, dst_mac, src_mac, ether_type, ttl,
+                 ip_proto, ip_src, ip_dst, src_port, dst_port, tcp_flags)
+        pkt_off += read_u32(buf, pkt_off)
+    return n
+
+
+# Capture loop handing each ring block or recvmmsg() batch to batch_handler as
+# a PacketBatch. The batch is reused, copy what you want to keep.
+def receive_batches(sock, ring, batch_handler):
+    if ring is not None:
+        # Room for a block full of the shortest frames
+        batch = PacketBatch(BLOCK_SIZE // MIN_FRAME_STRIDE)
+        for block_off, _, _ in ring_blocks(sock, ring):
+            batch.fill_block(ring, block_off)
+            batch_handler(batch)
+        return
+
+    batch = PacketBatch(VLEN)
+    msgs, iovs, buf = create_recv_batch()
+    offsets = np.arange(VLEN, dtype=np.int64) * FRAME_SIZE
+    # The msg_len fields of msgs, read in place (one every sizeof(mmsghdr) bytes)
+    msgs_bytes = (ctypes.c_char * ctypes.sizeof(msgs)).from_buffer(msgs)
+    lengths = np.ndarray((VLEN,), np.uint32, buffer=msgs_bytes,
+                         offset=mmsghdr.msg_len.offset, strides=(ctypes.sizeof(mmsghdr),))
+    for n in recv_batches(sock, msgs):
+        batch.fill(buf, offsets[:n], lengths[:n])
+        batch_handler(batch)
+
+def print_syn(batch):
+    syn = batch.tcp_syn()
+    for src, dst, port in zip(batch.ip_src[syn], batch.ip_dst[syn], batch.dst_port[syn]):
+        print("SYN {} -> {}:{}".format(socket.inet_ntoa(int(src).to_bytes(4, "big")),
+                                       socket.inet_ntoa(int(dst).to_bytes(4, "big")), port))
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    s = create_socket()
+    ring = create_rx_ring(s)
+    receive_batches(s, ring, print_syn)
@@ -1,11 +1,182 @@
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import platform
+import select
 import socket
 import sys
-from struct import unpack
+import threading
+import time
+from collections import deque
+from struct import Struct, pack, pack_into
+
+# Optional C parser, see fast_parse.pyx (build it with: cythonize -i fast_parse.pyx)
+# It is not used on PyPy: calling a C extension goes through its slow CPython
+# compatibility layer, while the JIT already compiles the Python parsers below.
+try:
+    if platform.python_implementation() == "PyPy":
+        raise ImportError("fast_parse is slower than the JIT on PyPy")
+    import fast_parse
+except ImportError:
+    fast_parse = None
 
 ETH_ALL = 0x0003
 ETH_LEN = 14
 BUF_SIZE = 65565
 
+# Header layouts compiled once at import time, so the format strings are not
+# looked up and parsed again for every packet.
+# See: https://docs.python.org/3/library/struct.html#struct.Struct
+ETH_HDR = Struct("!6s6sH")
+# Only the IPv4 fields we use: version/IHL, flags/fragment offset, TTL, protocol
+# and addresses. 5x and 2x skip the bytes in between, which is cheaper than
+# unpacking them (or reading the fields one by one from a memoryview).
+IP_HDR = Struct("!B5xHBB2x4s4s")
+TCP_HDR = Struct("!HHLLH")
+UDP_HDR = Struct("!HHHH")
+ICMP_HDR = Struct("!BBH")
+
+# (URG, ACK, PSH, RST, SYN, FIN) for every value of the TCP flags byte, so the
+# six flags of a packet are one table lookup instead of six shift-and-mask.
+FLAGS_LUT = [(b >> 5 & 1, b >> 4 & 1, b >> 3 & 1, b >> 2 & 1, b >> 1 & 1, b & 1) for b in range(256)]
+
+# Number of packets pulled from the kernel with a single recvmmsg() call and the
+# size of the buffer for each of them (big enough for a 1500 bytes MTU frame,
+# longer frames are truncated but their headers can still be parsed).
+VLEN = 128
+FRAME_SIZE = 2048
+
+# Text printed for each layer. Shared by the Python parsers below and by
+# handle_frame_fast() which formats the fields decoded by fast_parse.
+ETH_TEXT = "  source MAC: {} destination MAC: {} Prototype: {}"
+IPV4_TEXT = ("\n\t - IPv4 Packet:"
+             "\n\t\t - Version: {}, Header Length: {}, TTL:{},"
+             "\n\t\t - Protocol: {}, Source: {}, Destination: {}")
+ICMP_TEXT = ("\n\n\t\t - IMCP Packet:"
+             "\n\t\t\t - Type: {}"
+             "\n\t\t\t - Code: {}"
+             "\n\t\t\t - Checksum: {}")
+TCP_TEXT = ("\n\n\t\t - TCP Packet:"
+            "\n\t\t\t - Source Port: {}"
+            "\n\t\t\t - Destination Port: {}"
+            "\n\t\t\t - Sequence Number: {}"
+            "\n\t\t\t - Acknowledgment Number: {}"
+            "\n\t\t\t - Flags ==> URG: {}, ACK: {}, PSH: {}, RST: {}, SYN: {}, FIN: {}")
+UDP_TEXT = ("\n\n\t\t - UDP Packet:"
+            "\n\t\t\t - Source Port: {}"
+            "\n\t\t\t - Destination Port: {}"
+            "\n\t\t\t - Length: {}"
+            "\n\t\t\t - Checksum: {}")
+DATA_TEXT = "\n\t\t\t - Data: {}"
+OTHER_TEXT = "\nSome other protocols !!! Waiting for updates later"
+FRAGMENT_TEXT = "\n\t\t - Fragment at offset {}, not parsed"
+ERROR_TEXT = "Frame of {} bytes could not be parsed ({} so far). ERROR: {!r}"
+
+# Decoding every payload is a waste of time when nobody reads it, so the
+# payload is only shown when VERBOSE_PAYLOAD is set, and then only its first
+# PAYLOAD_PREVIEW bytes in hexadecimal.
+VERBOSE_PAYLOAD = False
+PAYLOAD_PREVIEW = 64
+
+# Writing to stdout is much slower than parsing a packet, so the capture loop
+# never prints: it appends one text record per packet to a bounded queue that a
+# background thread writes out every FLUSH_INTERVAL seconds. If the printer
+# falls behind, the oldest records are dropped instead of the packets.
+OUTPUT_MAXLEN = 10000
+FLUSH_INTERVAL = 0.01 # 10 ms
+output = deque(maxlen=OUTPUT_MAXLEN)
+
+# Same idea for the parsing itself: with start_worker() the capture loop only
+# copies the frames in a bounded queue, and a worker thread parses them. When
+# the worker falls behind, the oldest frames are dropped.
+# Only the first WORKER_SNAPLEN bytes of a frame are copied, enough for the
+# longest IPv4 and TCP headers (60 bytes each) and the payload we may print: a
+# frame can be up to 64 KB on lo or with GSO, so the full queue stays around
+# 13 MB instead of several GB.
+QUEUE_MAXLEN = 65536
+WORKER_SNAPLEN = ETH_LEN + 60 + 60 + PAYLOAD_PREVIEW
+
+# The default receive buffer (net.core.rmem_max, ~208 KB) overflows quickly at a
+# high packet rate. Size it for the number of packets we want to keep in flight
+# times the frame size: 6144 * 2048 = 12 MB. SO_RCVBUFFORCE (needs CAP_NET_ADMIN,
+# which we have as we run as root for the raw socket) can go above rmem_max.
+RCVBUF_PACKETS = 6144
+SO_RCVBUFFORCE = 33
+
+# Scheduling of the capture: SO_PRIORITY (0-6 without CAP_NET_ADMIN) is the
+# priority of the socket's packets in the kernel, SO_BUSY_POLL makes the kernel
+# poll the NIC queue for up to BUSY_POLL_USEC microseconds when we read instead
+# of waiting for an interrupt. The capture thread is pinned to CAPTURE_CPU
+# (None: the last CPU we may run on, NIC interrupts are usually handled on the
+# first ones) so it does not compete with the softirqs filling the socket.
+SOCKET_PRIORITY = 6
+SO_BUSY_POLL = 46
+BUSY_POLL_USEC = 50
+CAPTURE_CPU = None
+
+# Classic BPF filter run by the kernel on every frame before it is queued for
+# us: frames whose EtherType is not in CAPTURE_ETHERTYPES (IPv4 = 0x0800 by
+# default) are dropped before costing us anything. Set it to None to capture
+# every frame. Equivalent to `tcpdump -dd ip`, see build_ethertype_filter().
+# See: https://docs.kernel.org/networking/filter.html
+CAPTURE_ETHERTYPES = (0x0800,)
+SO_ATTACH_FILTER = 26
+BPF_LD_H_ABS = 0x28 # load the 2 bytes at offset k
+BPF_JEQ_K = 0x15 # jump jt instructions forward if equal to k, else jf
+BPF_RET_K = 0x06 # accept k bytes of the frame (0 = drop it)
+
+# PACKET_MMAP ring buffer (TPACKET_V3): the kernel writes the frames directly
+# into blocks of a memory area shared with us, so reading a packet needs neither
+# a system call nor a copy. Values come from <linux/if_packet.h>.
+# See: https://docs.kernel.org/networking/packet_mmap.html
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+BLOCK_SIZE = 1 << 20 # 1 MB per block
+BLOCK_NR = 16
+RETIRE_TMO = 60 # ms before the kernel hands over a block that is not full
+# block_status, num_pkts, offset_to_first_pkt of a tpacket_block_desc
+BLOCK_HDR = Struct("=III")
+# tp_next_offset, tp_snaplen and tp_mac of a tpacket3_hdr
+FRAME_HDR = Struct("=I8xI8xH")
+
+# Python does not expose recvmmsg(2), so we call it from libc with ctypes.
+# See: https://man7.org/linux/man-pages/man2/recvmmsg.2.html
+libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+HAVE_RECVMMSG = hasattr(libc, "recvmmsg")
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+class sock_filter(ctypes.Structure):
+    _fields_ = [("code", ctypes.c_uint16),
+                ("jt", ctypes.c_uint8),
+                ("jf", ctypes.c_uint8),
+                ("k", ctypes.c_uint32)]
+
+class sock_fprog(ctypes.Structure):
+    _fields_ = [("len", ctypes.c_ushort),
+                ("filter", ctypes.POINTER(sock_filter))]
+
 # In linux socket.ntohs(0x0003) tells capture everything including ethernet frames.
 # To capture TCP, UDP, or ICMP only, instead of socket.ntohs(0x0003) you will write
 # socket.IPPROTO_TCP, socket.IPPROTO_UDP and socket.IPPROTO_ICMP respectively
@@ -16,19 +187,305 @@ def create_socket():
     except socket.error as msg:
         print("Socket could not be created. ERROR: " + str(msg[0]) + " " + msg[1])
         sys.exit()
+
+    rcvbuf = RCVBUF_PACKETS * FRAME_SIZE
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, rcvbuf)
+    except OSError:
+        # Without CAP_NET_ADMIN the kernel caps the value to rmem_max
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+
+    if CAPTURE_ETHERTYPES:
+        attach_ethertype_filter(s, CAPTURE_ETHERTYPES)
+
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY, SOCKET_PRIORITY)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_USEC)
+    except OSError:
+        # Kernel without busy polling support
+        pass
+
+    # We never block in recv, we wait for readiness with epoll instead
+    s.setblocking(False)
     return s
 
-def receive_packet(sock):
+"""
+For ethertypes = (0x0800,) this builds:
+    (000) ldh  [12]               load the EtherType
+    (001) jeq  #0x800  jt 1 jf 0  IPv4 ? go to (003)
+    (002) ret  #0                 no match: drop the frame
+    (003) ret  #262144            match: keep the whole frame
+Equivalent to `tcpdump -dd ip`, which puts the accept before the drop
+(jt 0 jf 1). With n EtherTypes there is one jeq per EtherType, the k-th one
+(k = 0 .. n-1) jumping n - k instructions forward to the final ret.
+"""
+def build_ethertype_filter(ethertypes):
+    n = len(ethertypes)
+    program = [(BPF_LD_H_ABS, 0, 0, 12)]
+    for i, ethertype in enumerate(ethertypes):
+        # Jump over the next jeq's and the drop to reach the last instruction
+        program.append((BPF_JEQ_K, n - i, 0, ethertype))
+    program.append((BPF_RET_K, 0, 0, 0))
+    program.append((BPF_RET_K, 0, 0, 0x40000))
+    return (sock_filter * len(program))(*program)
+
+def attach_ethertype_filter(sock, ethertypes):
+    program = build_ethertype_filter(ethertypes)
+    fprog = sock_fprog(len(program), program)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(fprog))
+
+# Pin the calling thread (pid 0 is the calling thread on Linux) to one CPU
+def pin_capture_thread(cpu=CAPTURE_CPU):
+    if cpu is None:
+        cpu = max(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpu})
+    return cpu
+
+# epoll wakes us up in O(1) whatever the number of watched sockets, unlike
+# select/poll which scan all of them. In edge-triggered mode (EPOLLET) an event
+# is only reported when new data arrives, so after each wakeup we must read
+# until the socket is empty (EAGAIN).
+# See: https://man7.org/linux/man-pages/man7/epoll.7.html
+def create_epoll(sock):
+    ep = select.epoll()
+    ep.register(sock.fileno(), select.EPOLLIN | select.EPOLLET)
+    return ep
+
+"""
+struct tpacket_req3 {                     struct tpacket_block_desc {
+    unsigned int tp_block_size;               __u32 version;
+    unsigned int tp_block_nr;                 __u32 offset_to_priv;
+    unsigned int tp_frame_size;               __u32 block_status;        (offset 8)
+    unsigned int tp_frame_nr;                 __u32 num_pkts;            (offset 12)
+    unsigned int tp_retire_blk_tov;           __u32 offset_to_first_pkt; (offset 16)
+    unsigned int tp_sizeof_priv;              ...
+    unsigned int tp_feature_req_word;     };
+};
+                                          struct tpacket3_hdr {
+                                              __u32 tp_next_offset;      (offset 0)
+                                              __u32 tp_sec, tp_nsec;
+                                              __u32 tp_snaplen;          (offset 12)
+                                              __u32 tp_len, tp_status;
+                                              __u16 tp_mac;              (offset 24)
+                                              ...
+                                          };
+
+Ask the kernel for a TPACKET_V3 ring on the socket and map it in our memory.
+Returns None if the ring cannot be set up, then we fall back to recvmmsg().
+"""
+def create_rx_ring(sock):
+    req = pack("=7I", BLOCK_SIZE, BLOCK_NR, FRAME_SIZE, BLOCK_SIZE * BLOCK_NR // FRAME_SIZE,
+               RETIRE_TMO, 0, 0)
+    try:
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+        return mmap.mmap(sock.fileno(), BLOCK_SIZE * BLOCK_NR,
+                         mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+    except OSError as msg:
+        print("RX ring could not be created, using recvmmsg. ERROR: " + str(msg))
+        return None
+
+# Walk the ring block by block. A block belongs to us once the kernel sets
+# TP_STATUS_USER in its status; we yield its offset, number of packets and
+# offset of the first packet, and once the caller is done with its frames we
+# give it back to the kernel by writing TP_STATUS_KERNEL.
+def ring_blocks(sock, ring):
+    ep = create_epoll(sock)
+    block = 0
     while True:
-        raw_data, addr  = sock.recvfrom(BUF_SIZE)
-        ether_header = parse_ethernet_header(raw_data)
-        
-        # Check Ethernet Type for Internet Protocol version 4 (prototype value  = 8)
-        # See at: https://en.wikipedia.org/wiki/EtherType
-        if ether_header[3] == 8:
-            # Parse IP header by taking first 20 characters of IP packet
-            ipv4_data = raw_data[ETH_LEN:]
-            parse_ipv4_header(ipv4_data)
+        block_off = block * BLOCK_SIZE
+        block_status, num_pkts, first_pkt = BLOCK_HDR.unpack_from(ring, block_off + 8)
+        if not block_status & TP_STATUS_USER:
+            ep.poll()
+            continue
+
+        yield block_off, num_pkts, first_pkt
+
+        pack_into("=I", ring, block_off + 8, TP_STATUS_KERNEL)
+        block = (block + 1) % BLOCK_NR
+
+# Parse the frames of each block in place
+def receive_ring(sock, ring, handler):
+    ring_view = memoryview(ring)
+    for block_off, num_pkts, first_pkt in ring_blocks(sock, ring):
+        pkt_off = block_off + first_pkt
+        for _ in range(num_pkts):
+            next_off, snaplen, mac = FRAME_HDR.unpack_from(ring, pkt_off)
+            handler(ring_view[pkt_off + mac:pkt_off + mac + snaplen])
+            pkt_off += next_off
+
+# Allocate once the VLEN message headers used by recvmmsg(). Message i points
+# to the FRAME_SIZE bytes at offset i * FRAME_SIZE of a single buffer, so the
+# kernel writes the packets directly into memory that we keep reusing for the
+# whole capture, one after the other.
+def create_recv_batch():
+    msgs = (mmsghdr * VLEN)()
+    iovs = (iovec * VLEN)()
+    buf = bytearray(VLEN * FRAME_SIZE)
+    base = ctypes.addressof((ctypes.c_char * len(buf)).from_buffer(buf))
+    for i in range(VLEN):
+        iovs[i].iov_base = base + i * FRAME_SIZE
+        iovs[i].iov_len = FRAME_SIZE
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return msgs, iovs, buf
+
+# Receive up to VLEN packets with a single system call. MSG_DONTWAIT makes the
+# call non-blocking, so it returns 0 when the socket has nothing to read.
+def recv_batch(sock, msgs):
+    n = libc.recvmmsg(sock.fileno(), msgs, VLEN, socket.MSG_DONTWAIT, None)
+    if n < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return 0
+        raise OSError(err, os.strerror(err))
+    return n
+
+# Wait until the socket is readable, then drain it batch by batch. Yields the
+# number of packets received in msgs.
+def recv_batches(sock, msgs):
+    ep = create_epoll(sock)
+    while True:
+        ep.poll()
+        n = recv_batch(sock, msgs)
+        while n > 0:
+            yield n
+            n = recv_batch(sock, msgs)
+
+# Used when the C library has no recvmmsg(): one packet per system call, but
+# still received into the same preallocated buffer, where recvfrom() would
+# allocate a new bytes object for every packet.
+def receive_into(sock, handler):
+    ep = create_epoll(sock)
+    buf = bytearray(BUF_SIZE)
+    frame = memoryview(buf)
+    while True:
+        ep.poll()
+        while True:
+            try:
+                n = sock.recv_into(buf, BUF_SIZE)
+            except BlockingIOError:
+                break
+            handler(frame[:n])
+
+def receive_packet(sock, ring=None, handler=None):
+    if handler is None:
+        handler = handle_frame_fast if fast_parse is not None else handle_eth_ipv4_tcp
+    if ring is not None:
+        receive_ring(sock, ring, handler)
+        return
+    if not HAVE_RECVMMSG:
+        receive_into(sock, handler)
+        return
+
+    msgs, iovs, buf = create_recv_batch()
+    frames = memoryview(buf)
+    for n in recv_batches(sock, msgs):
+        for i in range(n):
+            off = i * FRAME_SIZE
+            handler(frames[off:off + msgs[i].msg_len])
+
+# raw_data is a memoryview on the frame. The parsers never slice it (a slice of
+# bytes is a copy of the packet), they all get the same buffer and the offset
+# where their header starts.
+def handle_frame(raw_data):
+    if len(raw_data) < ETH_LEN:
+        return
+    dest, source, prototype = parse_ethernet_header(raw_data)
+    record = ETH_TEXT.format(source, dest, prototype)
+
+    # Check Ethernet Type for Internet Protocol version 4 (prototype value  = 8)
+    # See at: https://en.wikipedia.org/wiki/EtherType
+    # The IP header starts right after the 14 bytes of the MAC header
+    if prototype == 8 and len(raw_data) >= ETH_LEN + IP_HDR.size:
+        record += parse_ipv4_header(raw_data, ETH_LEN)
+    output.append(record)
+
+# Same as handle_frame() but the headers are decoded by the C parser of
+# fast_parse, Python only formats the text.
+def handle_frame_fast(raw_data):
+    pkt = fast_parse.parse_packet(raw_data)
+    if pkt is None:
+        return
+    prototype = socket.htons(pkt.ether_type)
+    record = ETH_TEXT.format(mac_addrs_text[pkt.src_mac], mac_addrs_text[pkt.dst_mac], prototype)
+    if prototype == 8 and pkt.has_ip:
+        record += IPV4_TEXT.format(pkt.version, pkt.ihl, pkt.ttl, pkt.protocol,
+                                   ip_addrs_text[pkt.src], ip_addrs_text[pkt.dst])
+        if pkt.frag_offset:
+            record += FRAGMENT_TEXT.format(pkt.frag_offset * 8)
+        elif pkt.ihl >= 20:
+            record += format_transport_fast(raw_data, pkt)
+    output.append(record)
+
+def format_transport_fast(raw_data, pkt):
+    if pkt.protocol not in PROTO_DISPATCH:
+        return OTHER_TEXT
+    # Header cut short by the end of the frame: print nothing rather than a
+    # header of zeros
+    if not pkt.has_l4:
+        return ""
+    if pkt.protocol == 1:
+        text = ICMP_TEXT.format(pkt.icmp_type, pkt.icmp_code, pkt.checksum)
+    elif pkt.protocol == 6:
+        text = TCP_TEXT.format(pkt.src_port, pkt.dst_port, pkt.seq, pkt.ack,
+                               *FLAGS_LUT[pkt.offset_flags & 0xFF])
+    else:
+        text = UDP_TEXT.format(pkt.src_port, pkt.dst_port, pkt.length, pkt.checksum)
+    return text + format_payload(raw_data, pkt.payload_offset)
+
+def format_payload(buf, off):
+    if not VERBOSE_PAYLOAD:
+        return ""
+    return DATA_TEXT.format(buf[off:off + PAYLOAD_PREVIEW].hex(' '))
+
+# Printing is opt-in: records are only written out once this thread is started
+def print_output():
+    out = sys.stdout.buffer
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        records = []
+        while output:
+            records.append(output.popleft())
+        if records:
+            out.write("\n".join(records).encode('UTF-8', 'backslashreplace') + b"\n")
+            out.flush()
+
+def start_printer():
+    printer = threading.Thread(target=print_output, daemon=True)
+    printer.start()
+    return printer
+
+# Start a thread running handler on the queued frames and return the function
+# the capture loop calls instead of handler. The frames must be copied: the
+# ring block or recv buffer they live in is reused as soon as we return.
+# A frame the handler fails on is reported and skipped, otherwise the worker
+# would die and the capture would go on without ever printing again.
+def start_worker(handler):
+    frames = deque(maxlen=QUEUE_MAXLEN)
+    ready = threading.Event()
+
+    def work():
+        errors = 0
+        while True:
+            ready.wait()
+            ready.clear()
+            while frames:
+                frame = frames.popleft()
+                try:
+                    handler(memoryview(frame))
+                except Exception as msg:
+                    errors += 1
+                    output.append(ERROR_TEXT.format(len(frame), errors, msg))
+
+    def enqueue(raw_data):
+        frames.append(bytes(raw_data[:WORKER_SNAPLEN]))
+        # Only wake the worker up if it is waiting, setting the event takes a lock
+        if not ready.is_set():
+            ready.set()
+
+    threading.Thread(target=work, daemon=True).start()
+    return enqueue
 """
 +-----------------------------------------------------+ +----------------------+ +--------------+
 |+------------------+-----------------+-------------+ | |+-----------------+   | | CRC Checksum |
@@ -39,23 +496,41 @@ def receive_packet(sock):
 +-----------------------------------------------------+ +----------------------+
 
 This function will unpack the first 14 bytes of data that we sniffed.
-Here we use the unpack method in the struct module.
+Here we use the unpack_from method of a precompiled struct, which reads the
+header in place instead of unpacking a sliced copy of it.
 See more at: https://docs.python.org/3/library/struct.html
 """
 def parse_ethernet_header(raw_data):
-    mac_header = raw_data[:ETH_LEN]
-    mac_addrs = unpack("!6s6sH", mac_header)
-    dest = get_mac_addr(mac_addrs[0])
-    source = get_mac_addr(mac_addrs[1])
+    mac_addrs = ETH_HDR.unpack_from(raw_data, 0)
+    dest = mac_addrs_text[mac_addrs[0]]
+    source = mac_addrs_text[mac_addrs[1]]
     prototype = socket.htons(mac_addrs[2])
+    return dest, source, prototype
 
-    print("  source MAC: " + source + " destination MAC: " + dest + " Prototype: " + str(prototype))
-    
-    return mac_header, dest, source, prototype
-
+# bytes.hex() with a separator (Python 3.8+) formats the 6 bytes in a single C call
 def get_mac_addr(a):
-    mac_addr =  "%.2x:%.2x:%.2x:%.2x:%.2x:%.2x" % (a[0], a[1], a[2], a[3], a[4], a[5])
-    return mac_addr
+    return a.hex(':')
+
+# Formatted addresses by their raw bytes. The same few hosts show up in most of
+# the packets, so looking the text up in a dict is cheaper than formatting the
+# address again (__missing__ is only called the first time an address is seen).
+# The cache is emptied when it gets too big, e.g. during a scan with lots of
+# spoofed addresses.
+ADDR_CACHE_SIZE = 4096
+
+class AddressCache(dict):
+    def __init__(self, format_addr):
+        super().__init__()
+        self.format_addr = format_addr
+
+    def __missing__(self, addr):
+        if len(self) >= ADDR_CACHE_SIZE:
+            self.clear()
+        text = self[addr] = self.format_addr(addr)
+        return text
+
+mac_addrs_text = AddressCache(get_mac_addr)
+ip_addrs_text = AddressCache(socket.inet_ntoa)
 """
 An IP header looks like the following:
 
@@ -78,35 +553,41 @@ An IP header looks like the following:
 If the IHL is 5 then total size is 20 bytes hence options+padding is absent.
 For TCP packets the protocol is 6. Source address is the source IPv4 address in long format
 """
-def parse_ipv4_header(ip_data):
-    version_and_IHL = ip_data[0]
+def parse_ipv4_header(buf, off):
+    # One unpack reads the 20 bytes of the fixed header, see IP_HDR
+    version_and_IHL, flags_frag, ttl, protocol, src, dest = IP_HDR.unpack_from(buf, off)
     # use bit-shift to take first 4 bits to get version value
     version = version_and_IHL >> 4
     # get the header length (last 4 bits of the first byte)
     ihl = (version_and_IHL & 0x0F) * 4 # 0x0F is 00001111 
 
-    # 8x means 8 bytes padding, that means we do not get identification, flags and fragment offset. Simillar to 2x
-    ttl, protocol, src, dest = unpack("! 8x B B 2x 4s 4s", ip_data[:20])
+    src_addr = ip_addrs_text[src]
+    dest_addr = ip_addrs_text[dest]
+    text = IPV4_TEXT.format(version, ihl, ttl, protocol, src_addr, dest_addr)
 
-    src_addr = ".".join(map(str,src))
-    dest_addr = ".".join(map(str, dest))
-    print( '\t - ' + 'IPv4 Packet:')
-    print('\t\t - ' + 'Version: {}, Header Length: {}, TTL:{},'.format(version, ihl, ttl))
-    print('\t\t - ' + 'Protocol: {}, Source: {}, Destination: {}'.format(protocol, src_addr, dest_addr))
+    # Only the first fragment of a packet starts with the transport header, the
+    # next ones (fragment offset != 0, last 13 bits) are the middle of its data.
+    frag_offset = flags_frag & 0x1FFF
+    if frag_offset:
+        return text + FRAGMENT_TEXT.format(frag_offset * 8)
+    # An IHL below 5 (20 bytes) is not a valid header
+    if ihl < 20:
+        return text
 
     # Now that we have the internet layer unpacked, the next layer we have to unpack is the transport layer.
     # We can determine the protocol from the protocol ID in the IP header.
     # The following are the protocol IDs for some of the protocols:
     # TCP: 6, ICMP: 1, UDP: 17, RDP: 27, etc.
-    data = ip_data[ihl:]
-    if protocol == 1: # ICMP Packets (Internet Control Message Protocol)
-        parse_icmp_packet(data)
-    elif protocol == 6:
-        parse_tcp_packet(data)
-    elif protocol == 17:
-        parse_udp_packet(data)
+    # The parser of each protocol is looked up in PROTO_DISPATCH (see below).
+    # The transport header starts after the IHL bytes, so the IP options (if
+    # any) are skipped without being read. Each parser returns an empty text
+    # when the frame ends before the end of its header.
+    handler = PROTO_DISPATCH.get(protocol)
+    if handler:
+        text += handler(buf, off + ihl)
     else:
-        print("Some other protocols !!! Waiting for updates later")
+        text += OTHER_TEXT
+    return text
 
 """
  0               1               2               3               4
@@ -118,14 +599,12 @@ def parse_ipv4_header(ip_data):
  |      Internet Header + 64 bits of Original Data Datagram      |
  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 """
-def parse_icmp_packet(data):
-    imcp_header = unpack("! BBH",data[:4])
-    print("\n\t\t - IMCP Packet:")
-    print("\t\t\t - Type: {}".format(imcp_header[0]))
-    print("\t\t\t - Code: {}".format(imcp_header[1]))
-    print("\t\t\t - Checksum: {}".format(imcp_header[2]))
-    imcp_data = data[8:].decode('UTF-8', 'backslashreplace')
-    print("\t\t\t - Data: " + imcp_data)
+def parse_icmp_packet(buf, off):
+    if len(buf) < off + 8:
+        return ""
+    imcp_type, code, checksum = ICMP_HDR.unpack_from(buf, off)
+    return (ICMP_TEXT.format(imcp_type, code, checksum) +
+            format_payload(buf, off + 8))
 
 
 """
@@ -148,26 +627,17 @@ def parse_icmp_packet(data):
  |                             data                              |
  +-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+-+
 """
-def parse_tcp_packet(data):
-    tcp_header = unpack("! HHLLH", data[:14])
-    print("\n\t\t - TCP Packet:")
-    print("\t\t\t - Source Port: {}".format(tcp_header[0]))
-    print("\t\t\t - Destination Port: {}".format(tcp_header[1]))
-    print("\t\t\t - Sequence Number: {}".format(tcp_header[2]))
-    print("\t\t\t - Acknowledgment Number: {}".format(tcp_header[3]))
-    offset = tcp_header[4]
+def parse_tcp_packet(buf, off):
+    if len(buf) < off + 20:
+        return ""
+    src_port, dest_port, seq, ack, offset = TCP_HDR.unpack_from(buf, off)
     data_offset = (offset >> 12) * 4
-    flag_URG = (offset & 0x20) >> 5
-    flag_ACK = (offset & 0x10) >> 4
-    flag_PSH = (offset & 0x08) >> 3
-    flag_RST = (offset & 0x04) >> 2
-    flag_SYN = (offset & 0x02) >> 1
-    flag_FIN = offset & 0x01
-    print("\t\t\t - Flags ==> URG: {}, ACK: {}, PSH: {}, RST: {}, SYN: {}, FIN: {}".format(
-        flag_URG, flag_ACK, flag_PSH, flag_RST, flag_SYN, flag_FIN))
+    # The flags are the low byte of the data offset/flags field
+    flag_URG, flag_ACK, flag_PSH, flag_RST, flag_SYN, flag_FIN = FLAGS_LUT[offset & 0xFF]
 
-    tcp_data = data[data_offset:].decode('UTF-8', 'backslashreplace')
-    print("\t\t\t - Data: " + tcp_data)
+    return TCP_TEXT.format(
+        src_port, dest_port, seq, ack,
+        flag_URG, flag_ACK, flag_PSH, flag_RST, flag_SYN, flag_FIN) + format_payload(buf, off + data_offset)
 
 
 """
@@ -183,17 +653,66 @@ def parse_tcp_packet(data):
  |          data octets ...
  +---------------- ...
 """
-def parse_udp_packet(data):
-    udp_header = unpack("! HHHH", data[:8])
-    print("\n\t\t - UDP Packet:")
-    print("\t\t\t - Source Port: {}".format(udp_header[0]))
-    print("\t\t\t - Destination Port: {}".format(udp_header[1]))
-    print("\t\t\t - Length: {}".format(udp_header[1]))
-    print("\t\t\t - Checksum: {}".format(udp_header[2]))
-    udp_data = data[8:].decode('UTF-8', 'backslashreplace')
-    print("\t\t\t - Data: " + udp_data)
+def parse_udp_packet(buf, off):
+    if len(buf) < off + 8:
+        return ""
+    src_port, dest_port, length, checksum = UDP_HDR.unpack_from(buf, off)
+    return (UDP_TEXT.format(src_port, dest_port, length, checksum) +
+            format_payload(buf, off + 8))
+
+
+# Parser of each transport protocol, by protocol ID of the IP header. To
+# support a new protocol, write its parse function and add it here.
+PROTO_DISPATCH = {
+    1: parse_icmp_packet, # ICMP Packets (Internet Control Message Protocol)
+    6: parse_tcp_packet,
+    17: parse_udp_packet,
+}
+
+# Nearly all the traffic is Ethernet + IPv4 without options + TCP, which has a
+# fixed layout. For it we generate at import time a function with no calls
+# between layers and no branches on the protocols: one unpack of the 48 bytes
+# of the three headers we use, then one format of the whole record. Any other
+# frame (shorter than the 54 bytes of the headers, or with an unexpected value)
+# goes to the generic handle_frame().
+# The unpack and the names it is assigned to are generated from this list of
+# (field name, struct format), None being bytes we skip.
+ETH_IPV4_TCP_FIELDS = (
+    ("dst_mac", "6s"), ("src_mac", "6s"), ("ether_type", "H"),
+    ("version_ihl", "B"), (None, "5x"), ("flags_frag", "H"), ("ttl", "B"), ("protocol", "B"),
+    (None, "2x"), ("src", "4s"), ("dest", "4s"),
+    ("src_port", "H"), ("dest_port", "H"), ("seq", "L"), ("ack", "L"), ("offset", "H"),
+)
+ETH_IPV4_TCP_HDR = Struct("!" + "".join(fmt for name, fmt in ETH_IPV4_TCP_FIELDS))
+ETH_IPV4_TCP_TEXT = ETH_TEXT + IPV4_TEXT + TCP_TEXT
+IPV4_PROTOTYPE = socket.htons(0x0800)
+
+ETH_IPV4_TCP_SRC = """
+def handle_eth_ipv4_tcp(raw_data):
+    if len(raw_data) < {size}:
+        return handle_frame(raw_data)
+    {fields} = ETH_IPV4_TCP_HDR.unpack_from(raw_data, 0)
+    if ether_type != 0x0800 or version_ihl != 0x45 or protocol != 6 or flags_frag & 0x1FFF:
+        return handle_frame(raw_data)
+    output.append(ETH_IPV4_TCP_TEXT.format(
+        mac_addrs_text[src_mac], mac_addrs_text[dst_mac], IPV4_PROTOTYPE,
+        4, 20, ttl, 6, ip_addrs_text[src], ip_addrs_text[dest],
+        src_port, dest_port, seq, ack, *FLAGS_LUT[offset & 0xFF])
+        + format_payload(raw_data, {tcp_off} + (offset >> 12) * 4))
+""".format(size=ETH_LEN + 20 + 20, tcp_off=ETH_LEN + 20,
+           fields=", ".join(name for name, fmt in ETH_IPV4_TCP_FIELDS if name))
+
+# The function runs with this module's globals (output, handle_frame, ...) but
+# is defined in ns, and bound here explicitly
+ns = {}
+exec(compile(ETH_IPV4_TCP_SRC, "<eth_ipv4_tcp>", "exec"), globals(), ns)
+handle_eth_ipv4_tcp = ns["handle_eth_ipv4_tcp"]
 
 
 if __name__ == "__main__":
     s = create_socket()
-    receive_packet(s)
+    start_printer()
+    ring = create_rx_ring(s)
+    handler = start_worker(handle_frame_fast if fast_parse is not None else handle_eth_ipv4_tcp)
+    pin_capture_thread()
+    receive_packet(s, ring, handler)